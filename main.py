@@ -1,10 +1,19 @@
 import argparse
+import base64
 import csv
+import dbm
 import os
-import statistics
-from datetime import datetime, timedelta
-
+import shelve
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+import requests
 from atlassian.bitbucket import Cloud
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Environment variables
 BITBUCKET_USERNAME = os.getenv("BITBUCKET_USERNAME")
@@ -12,35 +21,168 @@ BITBUCKET_API_TOKEN = os.getenv("BITBUCKET_API_TOKEN")
 BITBUCKET_WORKSPACE = os.getenv("BITBUCKET_WORKSPACE")
 BITBUCKET_REPO = os.getenv("BITBUCKET_REPO")
 
-# Validate environment variables
-missing_vars = []
-for var_name in [
-    "BITBUCKET_USERNAME",
-    "BITBUCKET_API_TOKEN",
-    "BITBUCKET_WORKSPACE",
-    "BITBUCKET_REPO",
-]:
-    if not os.getenv(var_name):
-        missing_vars.append(var_name)
-
-if missing_vars:
-    print(f"Error: Missing required environment variables: {', '.join(missing_vars)}")
-    print("Please set these environment variables before running the script:")
-    for var in missing_vars:
-        print(f"  export {var}=your_value_here")
-    exit(1)
-
-
-def parse_args():
+SECONDS_PER_HOUR = 3600
+
+# HTTP connection pooling; the pool size per host follows --jobs (see create_session)
+POOL_CONNECTIONS = 16
+REQUEST_TIMEOUT = 30
+
+# Largest page size Bitbucket accepts when listing PRs
+PR_PAGE_LENGTH = 50
+
+# Fields requested when listing PRs; "next" must stay in the list for paging
+PR_LIST_FIELDS = ",".join(
+    [
+        "next",
+        "values.id",
+        "values.title",
+        "values.author.display_name",
+        "values.state",
+        "values.created_on",
+        "values.updated_on",
+        "values.source.branch.name",
+        "values.destination.branch.name",
+        "values.participants.role",
+    ]
+)
+
+# Largest page size used when counting commits and comments
+COUNT_PAGE_LENGTH = 100
+
+# Fields requested from a PR's diffstat; "next" must stay in the list for paging
+DIFFSTAT_FIELDS = "next,values.lines_added,values.lines_removed"
+
+# Columns written to the CSV output, in order
+CSV_FIELDNAMES = [
+    "id",
+    "title",
+    "author",
+    "state",
+    "created_on",
+    "updated_on",
+    "review_time_hours",
+    "review_time_days",
+    "reviewer_count",
+    "commits_count",
+    "comments_count",
+    "lines_added",
+    "lines_removed",
+    "total_lines_changed",
+    "files_changed",
+    "source_branch",
+    "destination_branch",
+]
+
+# Numeric columns summarized in the report
+SUMMARY_COLUMNS = [
+    "review_time_hours",
+    "reviewer_count",
+    "commits_count",
+    "comments_count",
+    "lines_added",
+    "lines_removed",
+    "total_lines_changed",
+    "files_changed",
+]
+
+# Per-PR tables in the summary, grouped under an optional markdown section:
+# (section, [(column, title, statistics shown), ...])
+SUMMARY_SECTIONS = [
+    (
+        None,
+        [
+            ("commits_count", "Commits per PR", ("average", "median", "min", "max")),
+            ("comments_count", "Comments per PR", ("average", "median", "min", "max")),
+            ("reviewer_count", "Reviewers per PR", ("average", "median", "min", "max")),
+        ],
+    ),
+    (
+        "Code Changes",
+        [
+            ("lines_added", "Lines Added per PR", ("average", "median", "total")),
+            ("lines_removed", "Lines Removed per PR", ("average", "median", "total")),
+            (
+                "total_lines_changed",
+                "Total Lines Changed per PR",
+                ("average", "median", "total"),
+            ),
+            (
+                "files_changed",
+                "Files Changed per PR",
+                ("average", "median", "min", "max", "total"),
+            ),
+        ],
+    ),
+]
+
+# Bump when the metrics dict changes so stale cache entries are ignored
+CACHE_VERSION = 1
+
+# Concurrency: PRs analyzed in parallel (--jobs), and API calls in flight per PR
+DEFAULT_JOBS = 8
+MAX_JOBS = 32
+PR_REQUEST_WORKERS = 4
+
+
+def validate_env():
+    """Exit with instructions if any required environment variable is missing"""
+    missing_vars = []
+    for var_name in [
+        "BITBUCKET_USERNAME",
+        "BITBUCKET_API_TOKEN",
+        "BITBUCKET_WORKSPACE",
+        "BITBUCKET_REPO",
+    ]:
+        if not os.getenv(var_name):
+            missing_vars.append(var_name)
+
+    if missing_vars:
+        print(
+            f"Error: Missing required environment variables: {', '.join(missing_vars)}"
+        )
+        print("Please set these environment variables before running the script:")
+        for var in missing_vars:
+            print(f"  export {var}=your_value_here")
+        exit(1)
+
+
+def positive_int(value):
+    """Parse a count option that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def jobs_count(value):
+    """Parse --jobs, keeping it within what Bitbucket's rate limits tolerate"""
+    jobs = int(value)
+    if not 1 <= jobs <= MAX_JOBS:
+        raise argparse.ArgumentTypeError(f"must be between 1 and {MAX_JOBS}")
+    return jobs
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Analyze Bitbucket Pull Requests")
     parser.add_argument("--days", type=int, help="Analyze PRs from the last N days")
     parser.add_argument(
         "--limit",
-        type=int,
+        type=positive_int,
         default=50,
         help="Analyze the last N merged PRs (default: 50)",
     )
     parser.add_argument("--pr-id", type=int, help="Analyze a specific PR by ID number")
+    parser.add_argument(
+        "--author",
+        type=str,
+        help="Only analyze PRs by this author (display name as shown in reports)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=jobs_count,
+        default=DEFAULT_JOBS,
+        help=f"Number of PRs to analyze in parallel, 1-{MAX_JOBS} (default: {DEFAULT_JOBS})",
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -53,27 +195,119 @@ def parse_args():
         default="pull_request_analysis.md",
         help="Output markdown report file name",
     )
-    return parser.parse_args()
-
-
-def get_pr_metrics(cloud, workspace, repo, pr):
-    """Get detailed metrics for a single PR"""
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=".pr_cache",
+        help="On-disk cache of merged PR metrics (default: .pr_cache)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Fetch every PR from Bitbucket without reading or writing the cache",
+    )
+    return parser.parse_args(argv)
+
+
+def build_query(args, cutoff_date=None):
+    """Build a Bitbucket query (BBQL) so filtering happens server-side"""
+    clauses = []
+    if cutoff_date:
+        clauses.append(f"updated_on >= {cutoff_date.isoformat(timespec='seconds')}")
+    if args.author:
+        # Escape backslashes first so they can't swallow the quote escapes
+        author = args.author.replace("\\", "\\\\").replace('"', '\\"')
+        clauses.append(f'author.display_name = "{author}"')
+    return " AND ".join(clauses)
+
+
+def create_session(jobs=DEFAULT_JOBS):
+    """Create an HTTP session that reuses keep-alive connections across requests"""
+    session = requests.Session()
+    # Back off with jitter so concurrent workers don't retry in lockstep
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        # One connection for every request that can be in flight at once
+        pool_maxsize=jobs * PR_REQUEST_WORKERS,
+        max_retries=retries,
+    )
+    session.mount("https://", adapter)
+    # Encode basic auth once rather than on every request
+    credentials = f"{BITBUCKET_USERNAME}:{BITBUCKET_API_TOKEN}".encode()
+    session.headers.update(
+        {
+            "Authorization": f"Basic {base64.b64encode(credentials).decode()}",
+            "Accept": "application/json",
+        }
+    )
+    return session
+
+
+def count_paged(cloud, url, item_field):
+    """Count a paged collection, using its size when Bitbucket reports one"""
+    params = {"pagelen": COUNT_PAGE_LENGTH, "fields": f"size,next,values.{item_field}"}
+    page = cloud.get(url, params=params)
+    if page and page.get("size") is not None:
+        return page["size"]
+
+    # Collections without a size (e.g. PR commits) are counted page by page
+    count = 0
+    while page:
+        count += len(page.get("values", []))
+        if not page.get("next"):
+            break
+        page = cloud.get(page["next"], absolute=True)
+    return count
+
+
+def sum_diffstat(cloud, url):
+    """Total lines added, lines removed and files changed in one pass over a diffstat"""
+    lines_added = lines_removed = files_changed = 0
+    for entry in cloud._get_paged(url, params={"fields": DIFFSTAT_FIELDS}):
+        # Binary files report null line counts
+        lines_added += entry.get("lines_added") or 0
+        lines_removed += entry.get("lines_removed") or 0
+        files_changed += 1
+    return lines_added, lines_removed, files_changed
+
+
+def get_pr_metrics(cloud, workspace, repo, pr, executor):
+    """Get detailed metrics for a single PR, fetching its endpoints on executor"""
     pr_id = pr["id"]
 
     # Calculate review time
-    created = datetime.fromisoformat(pr["created_on"].replace("Z", "+00:00"))
+    created = datetime.fromisoformat(pr["created_on"])
     if pr["state"] == "MERGED" and pr.get("updated_on"):
-        merged = datetime.fromisoformat(pr["updated_on"].replace("Z", "+00:00"))
-        review_time_hours = (merged - created).total_seconds() / 3600
+        merged = datetime.fromisoformat(pr["updated_on"])
+        review_time_hours = (merged - created).total_seconds() / SECONDS_PER_HOUR
         review_time_days = review_time_hours / 24
     else:
         review_time_hours = None
         review_time_days = None
 
-    # Get reviewers count
-    participants_url = f"repositories/{workspace}/{repo}/pullrequests/{pr_id}"
-    pr_detail = cloud.get(participants_url)
+    # Fetch PR detail, commits, comments and diffstat concurrently
+    base_url = f"repositories/{workspace}/{repo}/pullrequests/{pr_id}"
+
+    # Listed PRs already carry participants, so only fetch the detail if needed
+    detail_future = None
+    if "participants" not in pr:
+        detail_future = executor.submit(
+            cloud.get, base_url, params={"fields": "participants.role"}
+        )
+    commits_future = executor.submit(count_paged, cloud, f"{base_url}/commits", "hash")
+    comments_future = executor.submit(count_paged, cloud, f"{base_url}/comments", "id")
+    diffstat_future = executor.submit(sum_diffstat, cloud, f"{base_url}/diffstat")
 
+    # Get reviewers count
+    pr_detail = detail_future.result() if detail_future else pr
     reviewers = []
     if "participants" in pr_detail:
         reviewers = [
@@ -81,24 +315,17 @@ def get_pr_metrics(cloud, workspace, repo, pr):
         ]
     reviewer_count = len(reviewers)
 
-    # Get commits count
-    commits_url = f"repositories/{workspace}/{repo}/pullrequests/{pr_id}/commits"
-    commits = list(cloud._get_paged(commits_url))
-    commits_count = len(commits)
-
-    # Get comments count
-    comments_url = f"repositories/{workspace}/{repo}/pullrequests/{pr_id}/comments"
-    comments = list(cloud._get_paged(comments_url))
-    comments_count = len(comments)
+    # Get commits and comments count
+    commits_count = commits_future.result()
+    comments_count = comments_future.result()
 
     # Get code changes (lines added/removed and files changed)
-    diffstat_url = f"repositories/{workspace}/{repo}/pullrequests/{pr_id}/diffstat"
     try:
-        diffstats = list(cloud._get_paged(diffstat_url))
-        lines_added = sum(d.get("lines_added", 0) for d in diffstats)
-        lines_removed = sum(d.get("lines_removed", 0) for d in diffstats)
-        files_changed = len(diffstats)
-    except Exception:
+        lines_added, lines_removed, files_changed = diffstat_future.result()
+    except requests.HTTPError as e:
+        # PRs whose source branch is gone have no diffstat; anything else is an error
+        if e.response is None or e.response.status_code != 404:
+            raise
         lines_added = 0
         lines_removed = 0
         files_changed = 0
@@ -124,188 +351,271 @@ def get_pr_metrics(cloud, workspace, repo, pr):
     }
 
 
-def print_summary_stats(metrics_list, output_file="pull_request_analysis.md"):
-    """Print summary statistics to console and markdown file"""
-    if not metrics_list:
-        print("No PRs to analyze")
+class MetricsCache:
+    """Thread-safe on-disk cache of metrics for merged PRs"""
+
+    def __init__(self, filename, workspace, repo):
+        self._shelf = shelve.open(filename)
+        self._lock = threading.Lock()
+        # PR IDs are only unique within a repo, and one cache file serves them all
+        self._prefix = f"{workspace}/{repo}"
+
+    def key(self, pr):
+        """Merged PRs are immutable, so the ID and last update identify their metrics"""
+        if pr["state"] != "MERGED" or not pr.get("updated_on"):
+            return None
+        return f"{self._prefix}:{pr['id']}:{pr['updated_on']}"
+
+    def get(self, pr):
+        key = self.key(pr)
+        with self._lock:
+            if key is None or self._shelf is None:
+                return None
+            entry = self._shelf.get(key)
+        # Entries written by an older metrics layout are treated as misses
+        if entry is None or entry.get("version") != CACHE_VERSION:
+            return None
+        return entry["metrics"]
+
+    def set(self, pr, metrics):
+        key = self.key(pr)
+        entry = {
+            "version": CACHE_VERSION,
+            "fetched_at": datetime.now().astimezone().isoformat(),
+            "metrics": metrics,
+        }
+        with self._lock:
+            # Workers still running after an interrupt may finish once closed
+            if key is not None and self._shelf is not None:
+                self._shelf[key] = entry
+
+    def close(self):
+        with self._lock:
+            self._shelf.close()
+            self._shelf = None
+
+
+def open_cache(filename, workspace, repo):
+    """Open the metrics cache, or return None so the run continues without it"""
+    try:
+        return MetricsCache(filename, workspace, repo)
+    # dbm.error is a tuple of every backend's error class plus OSError
+    except dbm.error as e:
+        print(f"Warning: Could not open cache {filename} ({e}), continuing without it")
+        return None
+
+
+def collect_prs(prs, limit=None, cutoff=None):
+    """Collect listed PRs up to the limit, stopping at the first one older than cutoff"""
+    collected = []
+    try:
+        for pr in prs:
+            # PRs arrive newest first, so every later page is older still. cutoff is
+            # a UTC "YYYY-MM-DDTHH:MM:SS" string; a later fraction or offset sorts after it.
+            if cutoff and pr["updated_on"] < cutoff:
+                break
+
+            collected.append(pr)
+
+            # Stop before the generator requests another page
+            if limit and len(collected) >= limit:
+                break
+    except KeyboardInterrupt:
+        print("\n\nOperation cancelled by user during PR iteration.")
+        print(f"Partial results: {len(collected)} PRs fetched so far.")
+        # Continue with whatever PRs we managed to fetch
+    return collected
+
+
+def analyze_pr(cloud, workspace, repo, pr, executor, cache=None):
+    """Get metrics for a single PR, returning None if the analysis fails"""
+    metrics = None
+    if cache:
+        try:
+            metrics = cache.get(pr)
+        except Exception:
+            # The cache is only an optimisation, so an unreadable entry is a miss
+            metrics = None
+    if metrics is not None:
+        return metrics
+
+    try:
+        metrics = get_pr_metrics(cloud, workspace, repo, pr, executor)
+    except Exception as e:
+        print(f"  Error analyzing PR #{pr['id']}: {e}")
+        return None
+
+    if cache:
+        try:
+            cache.set(pr, metrics)
+        except Exception as e:
+            print(f"  Error caching PR #{pr['id']}: {e}")
+    return metrics
+
+
+@dataclass
+class SummaryStats:
+    """Column values accumulated as each PR is analyzed"""
+
+    count: int = 0
+    columns: dict = field(
+        default_factory=lambda: {column: [] for column in SUMMARY_COLUMNS}
+    )
+
+    def add(self, metrics):
+        """Record the summary columns of one PR's metrics"""
+        self.count += 1
+        for column, values in self.columns.items():
+            if metrics[column] is not None:
+                values.append(metrics[column])
+
+
+def analyze_pull_requests(
+    cloud, workspace, repo, prs, writer, cache=None, jobs=DEFAULT_JOBS
+):
+    """Analyze PRs concurrently, writing each CSV row as soon as it is ready"""
+    summary = SummaryStats()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    # Shared by every PR so each one doesn't spin up its own threads
+    request_executor = ThreadPoolExecutor(max_workers=jobs * PR_REQUEST_WORKERS)
+    try:
+        results = executor.map(
+            lambda pr: analyze_pr(cloud, workspace, repo, pr, request_executor, cache),
+            prs,
+        )
+        for i, (pr, metrics) in enumerate(zip(prs, results), 1):
+            print(f"Analyzed PR {i}/{len(prs)}: #{pr['id']} - {pr['title'][:50]}...")
+            if metrics is not None:
+                writer.writerow([metrics[name] for name in CSV_FIELDNAMES])
+                summary.add(metrics)
+    except KeyboardInterrupt:
+        print("\n\nOperation cancelled by user during analysis.")
+        print(f"Partial results: {summary.count} PRs analyzed so far.")
+    finally:
+        # Drop queued PRs but let running ones finish, so none of them submits
+        # to the request pool after it has been shut down
+        executor.shutdown(wait=True, cancel_futures=True)
+        request_executor.shutdown(wait=False, cancel_futures=True)
+    return summary
+
+
+Stats = namedtuple("Stats", "average median min max total")
+
+
+def describe(values):
+    """Get average, median, min, max and total of a list of numbers in one sort"""
+    ordered = sorted(values)
+    count = len(ordered)
+    middle = count // 2
+    if count % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2
+    total = sum(ordered)
+    return Stats(total / count, median, ordered[0], ordered[-1], total)
+
+
+def format_stat(stats, name, markdown=False):
+    """Format one statistic the way the console and markdown reports show it"""
+    value = getattr(stats, name)
+    if name == "average":
+        return f"{value:.2f}"
+    if name == "median":
+        return f"{value:.0f}"
+    if name == "total" and markdown:
+        return f"{value:,}"
+    return f"{value}"
+
+
+def print_summary_stats(summary, output_file="pull_request_analysis.md", stream=None):
+    """Print summary statistics to console (or stream) and markdown file"""
+    if not summary.count:
+        print("No PRs to analyze", file=stream)
         return
 
-    # Prepare output lines
-    output_lines = []
+    review_times = summary.columns["review_time_hours"]
+    review_times = describe(review_times) if review_times else None
+    sections = [
+        (
+            section,
+            [
+                (title, names, describe(summary.columns[column]))
+                for column, title, names in tables
+            ],
+        )
+        for section, tables in SUMMARY_SECTIONS
+    ]
+
+    # Collect console lines and print them in one call
+    lines = ["\n" + "=" * 80, "PULL REQUEST ANALYSIS SUMMARY", "=" * 80]
+    lines.append(f"\nTotal PRs analyzed: {summary.count}")
 
-    def add_line(line=""):
-        print(line)
-        output_lines.append(line)
+    if review_times:
+        lines.append("\nReview Time (hours):")
+        for name in ("average", "median", "min", "max"):
+            hours = getattr(review_times, name)
+            lines.append(
+                f"  {name.capitalize() + ':':<8} {hours:.2f} hours ({hours / 24:.2f} days)"
+            )
 
-    add_line("\n" + "=" * 80)
-    add_line("PULL REQUEST ANALYSIS SUMMARY")
-    add_line("=" * 80)
+    for _, tables in sections:
+        for title, names, stats in tables:
+            lines.append(f"\n{title}:")
+            for name in names:
+                lines.append(
+                    f"  {name.capitalize() + ':':<8} {format_stat(stats, name)}"
+                )
 
-    add_line(f"\nTotal PRs analyzed: {len(metrics_list)}")
+    lines.append("\n" + "=" * 80)
+    print("\n".join(lines), file=stream)
 
-    # Review time statistics
-    review_times = [
-        m["review_time_hours"]
-        for m in metrics_list
-        if m["review_time_hours"] is not None
+    # Build the markdown report and write it in one call
+    report = [
+        "# Pull Request Analysis Report\n\n",
+        f"*Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}*\n\n",
+        "## Summary\n\n",
+        f"**Total PRs analyzed:** {summary.count}\n\n",
     ]
+
     if review_times:
-        add_line("\nReview Time (hours):")
-        add_line(
-            f"  Average: {statistics.mean(review_times):.2f} hours ({statistics.mean(review_times) / 24:.2f} days)"
-        )
-        add_line(
-            f"  Median:  {statistics.median(review_times):.2f} hours ({statistics.median(review_times) / 24:.2f} days)"
-        )
-        add_line(
-            f"  Min:     {min(review_times):.2f} hours ({min(review_times) / 24:.2f} days)"
-        )
-        add_line(
-            f"  Max:     {max(review_times):.2f} hours ({max(review_times) / 24:.2f} days)"
-        )
+        report.append("## Review Time\n\n")
+        report.append("| Metric | Hours | Days |\n")
+        report.append("|--------|-------|------|\n")
+        for name in ("average", "median", "min", "max"):
+            hours = getattr(review_times, name)
+            report.append(f"| {name.capitalize()} | {hours:.2f} | {hours / 24:.2f} |\n")
+        report.append("\n")
+
+    for section, tables in sections:
+        heading = "##"
+        if section:
+            report.append(f"## {section}\n\n")
+            heading = "###"
+        for title, names, stats in tables:
+            report.append(f"{heading} {title}\n\n")
+            report.append("| Metric | Value |\n")
+            report.append("|--------|-------|\n")
+            for name in names:
+                report.append(
+                    f"| {name.capitalize()} | {format_stat(stats, name, markdown=True)} |\n"
+                )
+            report.append("\n")
 
-    # Commits statistics
-    commits = [m["commits_count"] for m in metrics_list]
-    add_line("\nCommits per PR:")
-    add_line(f"  Average: {statistics.mean(commits):.2f}")
-    add_line(f"  Median:  {statistics.median(commits):.0f}")
-    add_line(f"  Min:     {min(commits)}")
-    add_line(f"  Max:     {max(commits)}")
-
-    # Comments statistics
-    comments = [m["comments_count"] for m in metrics_list]
-    add_line("\nComments per PR:")
-    add_line(f"  Average: {statistics.mean(comments):.2f}")
-    add_line(f"  Median:  {statistics.median(comments):.0f}")
-    add_line(f"  Min:     {min(comments)}")
-    add_line(f"  Max:     {max(comments)}")
-
-    # Reviewers statistics
-    reviewers = [m["reviewer_count"] for m in metrics_list]
-    add_line("\nReviewers per PR:")
-    add_line(f"  Average: {statistics.mean(reviewers):.2f}")
-    add_line(f"  Median:  {statistics.median(reviewers):.0f}")
-    add_line(f"  Min:     {min(reviewers)}")
-    add_line(f"  Max:     {max(reviewers)}")
-
-    # Code changes statistics
-    lines_added = [m["lines_added"] for m in metrics_list]
-    lines_removed = [m["lines_removed"] for m in metrics_list]
-    total_lines = [m["total_lines_changed"] for m in metrics_list]
-    files_changed = [m["files_changed"] for m in metrics_list]
-
-    add_line("\nLines Added per PR:")
-    add_line(f"  Average: {statistics.mean(lines_added):.2f}")
-    add_line(f"  Median:  {statistics.median(lines_added):.0f}")
-    add_line(f"  Total:   {sum(lines_added)}")
-
-    add_line("\nLines Removed per PR:")
-    add_line(f"  Average: {statistics.mean(lines_removed):.2f}")
-    add_line(f"  Median:  {statistics.median(lines_removed):.0f}")
-    add_line(f"  Total:   {sum(lines_removed)}")
-
-    add_line("\nTotal Lines Changed per PR:")
-    add_line(f"  Average: {statistics.mean(total_lines):.2f}")
-    add_line(f"  Median:  {statistics.median(total_lines):.0f}")
-    add_line(f"  Total:   {sum(total_lines)}")
-
-    add_line("\nFiles Changed per PR:")
-    add_line(f"  Average: {statistics.mean(files_changed):.2f}")
-    add_line(f"  Median:  {statistics.median(files_changed):.0f}")
-    add_line(f"  Min:     {min(files_changed)}")
-    add_line(f"  Max:     {max(files_changed)}")
-    add_line(f"  Total:   {sum(files_changed)}")
-
-    add_line("\n" + "=" * 80)
-
-    # Write markdown file
     with open(output_file, "w") as f:
-        f.write("# Pull Request Analysis Report\n\n")
-        f.write(f"*Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}*\n\n")
-        f.write("## Summary\n\n")
-        f.write(f"**Total PRs analyzed:** {len(metrics_list)}\n\n")
-
-        if review_times:
-            f.write("## Review Time\n\n")
-            f.write("| Metric | Hours | Days |\n")
-            f.write("|--------|-------|------|\n")
-            f.write(
-                f"| Average | {statistics.mean(review_times):.2f} | {statistics.mean(review_times) / 24:.2f} |\n"
-            )
-            f.write(
-                f"| Median | {statistics.median(review_times):.2f} | {statistics.median(review_times) / 24:.2f} |\n"
-            )
-            f.write(
-                f"| Min | {min(review_times):.2f} | {min(review_times) / 24:.2f} |\n"
-            )
-            f.write(
-                f"| Max | {max(review_times):.2f} | {max(review_times) / 24:.2f} |\n\n"
-            )
+        f.write("".join(report))
 
-        f.write("## Commits per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(commits):.2f} |\n")
-        f.write(f"| Median | {statistics.median(commits):.0f} |\n")
-        f.write(f"| Min | {min(commits)} |\n")
-        f.write(f"| Max | {max(commits)} |\n\n")
-
-        f.write("## Comments per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(comments):.2f} |\n")
-        f.write(f"| Median | {statistics.median(comments):.0f} |\n")
-        f.write(f"| Min | {min(comments)} |\n")
-        f.write(f"| Max | {max(comments)} |\n\n")
-
-        f.write("## Reviewers per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(reviewers):.2f} |\n")
-        f.write(f"| Median | {statistics.median(reviewers):.0f} |\n")
-        f.write(f"| Min | {min(reviewers)} |\n")
-        f.write(f"| Max | {max(reviewers)} |\n\n")
-
-        f.write("## Code Changes\n\n")
-        f.write("### Lines Added per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(lines_added):.2f} |\n")
-        f.write(f"| Median | {statistics.median(lines_added):.0f} |\n")
-        f.write(f"| Total | {sum(lines_added):,} |\n\n")
-
-        f.write("### Lines Removed per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(lines_removed):.2f} |\n")
-        f.write(f"| Median | {statistics.median(lines_removed):.0f} |\n")
-        f.write(f"| Total | {sum(lines_removed):,} |\n\n")
-
-        f.write("### Total Lines Changed per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(total_lines):.2f} |\n")
-        f.write(f"| Median | {statistics.median(total_lines):.0f} |\n")
-        f.write(f"| Total | {sum(total_lines):,} |\n\n")
-
-        f.write("### Files Changed per PR\n\n")
-        f.write("| Metric | Value |\n")
-        f.write("|--------|-------|\n")
-        f.write(f"| Average | {statistics.mean(files_changed):.2f} |\n")
-        f.write(f"| Median | {statistics.median(files_changed):.0f} |\n")
-        f.write(f"| Min | {min(files_changed)} |\n")
-        f.write(f"| Max | {max(files_changed)} |\n")
-        f.write(f"| Total | {sum(files_changed):,} |\n\n")
-
-    print(f"\nMarkdown report saved to {output_file}")
+    print(f"\nMarkdown report saved to {output_file}", file=stream)
 
 
 def main():
+    validate_env()
     args = parse_args()
 
     # Initialize Bitbucket Cloud connection
     print("Connecting to Bitbucket Cloud...")
-    cloud = Cloud(username=BITBUCKET_USERNAME, password=BITBUCKET_API_TOKEN, cloud=True)
+    cloud = Cloud(
+        session=create_session(args.jobs), timeout=REQUEST_TIMEOUT, cloud=True
+    )
 
     # Handle specific PR ID
     if args.pr_id:
@@ -323,21 +633,7 @@ def main():
             return
     else:
         # Get merged pull requests
-        print("Fetching merged pull requests...")
-        url = f"repositories/{BITBUCKET_WORKSPACE}/{BITBUCKET_REPO}/pullrequests"
-        try:
-            prs = cloud._get_paged(url, params={"state": "MERGED"})
-        except KeyboardInterrupt:
-            print("\n\nOperation cancelled by user during PR fetching.")
-            return
-        except Exception as e:
-            print(f"Error fetching pull requests: {e}")
-            return
-
-        # Filter PRs based on criteria
-        filtered_prs = []
         cutoff_date = None
-
         if args.days:
             cutoff_date = datetime.now(
                 tz=datetime.now().astimezone().tzinfo
@@ -346,84 +642,63 @@ def main():
                 f"Filtering PRs merged after {cutoff_date.strftime('%Y-%m-%d %H:%M:%S')}"
             )
 
+        print("Fetching merged pull requests...")
+        url = f"repositories/{BITBUCKET_WORKSPACE}/{BITBUCKET_REPO}/pullrequests"
+        params = {
+            "state": "MERGED",
+            # Don't fetch a full page when the limit needs fewer PRs
+            "pagelen": min(args.limit or PR_PAGE_LENGTH, PR_PAGE_LENGTH),
+            "sort": "-updated_on",
+            "fields": PR_LIST_FIELDS,
+        }
+        query = build_query(args, cutoff_date)
+        if query:
+            params["q"] = query
         try:
-            for pr in prs:
-                if args.limit and len(filtered_prs) >= args.limit:
-                    break
-
-                if args.days:
-                    updated = datetime.fromisoformat(
-                        pr["updated_on"].replace("Z", "+00:00")
-                    )
-                    if updated < cutoff_date:
-                        continue
-
-                filtered_prs.append(pr)
+            prs = cloud._get_paged(url, params=params)
         except KeyboardInterrupt:
-            print("\n\nOperation cancelled by user during PR iteration.")
-            print(f"Partial results: {len(filtered_prs)} PRs fetched so far.")
-            # Continue with whatever PRs we managed to fetch
+            print("\n\nOperation cancelled by user during PR fetching.")
+            return
+        except Exception as e:
+            print(f"Error fetching pull requests: {e}")
+            return
+
+        # Bitbucket timestamps are UTC ISO 8601, which sorts lexicographically
+        cutoff = None
+        if cutoff_date:
+            cutoff = cutoff_date.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        filtered_prs = collect_prs(prs, args.limit, cutoff)
 
     print(f"Found {len(filtered_prs)} PR(s) to analyze")
 
-    # Collect metrics for each PR
-    all_metrics = []
+    # Collect metrics for each PR, writing CSV rows as they complete
+    cache = None
+    if not args.no_cache:
+        cache = open_cache(args.cache, BITBUCKET_WORKSPACE, BITBUCKET_REPO)
+    print(f"Writing results to {args.output}...")
     try:
-        for i, pr in enumerate(filtered_prs, 1):
-            print(
-                f"Analyzing PR {i}/{len(filtered_prs)}: #{pr['id']} - {pr['title'][:50]}..."
+        # Line buffered so rows already analyzed survive an abrupt exit
+        with open(args.output, "w", newline="", buffering=1) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_FIELDNAMES)
+            summary = analyze_pull_requests(
+                cloud,
+                BITBUCKET_WORKSPACE,
+                BITBUCKET_REPO,
+                filtered_prs,
+                writer,
+                cache,
+                jobs=args.jobs,
             )
-            try:
-                metrics = get_pr_metrics(cloud, BITBUCKET_WORKSPACE, BITBUCKET_REPO, pr)
-                all_metrics.append(metrics)
-            except KeyboardInterrupt:
-                print(
-                    f"\n\nOperation cancelled by user while analyzing PR #{pr['id']}."
-                )
-                print(f"Partial results: {len(all_metrics)} PRs analyzed so far.")
-                break
-            except Exception as e:
-                print(f"  Error analyzing PR #{pr['id']}: {e}")
-                continue
-    except KeyboardInterrupt:
-        print("\n\nOperation cancelled by user during analysis.")
-        print(f"Partial results: {len(all_metrics)} PRs analyzed so far.")
+    finally:
+        if cache:
+            cache.close()
 
     # Print summary statistics
-    print_summary_stats(all_metrics, args.report)
+    print_summary_stats(summary, args.report)
 
-    # Write to CSV
-    if all_metrics:
-        print(f"\nWriting results to {args.output}...")
-        try:
-            with open(args.output, "w", newline="") as csvfile:
-                fieldnames = [
-                    "id",
-                    "title",
-                    "author",
-                    "state",
-                    "created_on",
-                    "updated_on",
-                    "review_time_hours",
-                    "review_time_days",
-                    "reviewer_count",
-                    "commits_count",
-                    "comments_count",
-                    "lines_added",
-                    "lines_removed",
-                    "total_lines_changed",
-                    "files_changed",
-                    "source_branch",
-                    "destination_branch",
-                ]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(all_metrics)
-
-            print(f"Analysis complete! Results saved to {args.output}")
-        except KeyboardInterrupt:
-            print("\n\nOperation cancelled by user while writing results.")
-            print(f"Partial results may have been saved to {args.output}")
+    if summary.count:
+        print(f"\nAnalysis complete! Results saved to {args.output}")
     else:
         print("No metrics collected.")
 
@@ -2,7 +2,71 @@
 Unit tests
 """
 
+import argparse
+import csv
+import io
+import os
+import re
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from main import (
+    CACHE_VERSION,
+    CSV_FIELDNAMES,
+    DEFAULT_JOBS,
+    MAX_JOBS,
+    PR_REQUEST_WORKERS,
+    MetricsCache,
+    Stats,
+    SummaryStats,
+    analyze_pr,
+    analyze_pull_requests,
+    build_query,
+    collect_prs,
+    create_session,
+    describe,
+    get_pr_metrics,
+    jobs_count,
+    open_cache,
+    parse_args,
+    print_summary_stats,
+    validate_env,
+)
+
+BASE_URL = "repositories/workspace/repo/pullrequests/1"
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"HTTP {status_code}", response=response)
+
+
+class FakeCloud:
+    """Stand-in for the Bitbucket client serving canned responses by URL"""
+
+    def __init__(self, responses, paged):
+        self.responses = responses
+        self.paged = paged
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.responses[url]
+
+    def _get_paged(self, url, **kwargs):
+        if isinstance(self.paged[url], Exception):
+            raise self.paged[url]
+        return iter(self.paged[url])
 
 
 class TestCustomFunction(unittest.TestCase):
@@ -13,5 +77,585 @@ class TestCustomFunction(unittest.TestCase):
         self.assertEqual(True, True)
 
 
+class TestCreateSession(unittest.TestCase):
+    @patch.multiple("main", BITBUCKET_USERNAME="user", BITBUCKET_API_TOKEN="token")
+    def test_basic_auth_header_is_precomputed(self):
+        """
+        Test the session carries a ready-made basic auth header
+        """
+        session = create_session()
+        self.assertEqual(session.headers["Authorization"], "Basic dXNlcjp0b2tlbg==")
+        self.assertIsNone(session.auth)
+
+    def test_pool_fits_every_request_in_flight(self):
+        """
+        Test the connection pool holds a connection for each concurrent request
+        """
+        for jobs in (1, DEFAULT_JOBS, MAX_JOBS):
+            with self.subTest(jobs=jobs):
+                adapter = create_session(jobs).get_adapter("https://")
+                self.assertEqual(
+                    adapter.poolmanager.connection_pool_kw["maxsize"],
+                    jobs * PR_REQUEST_WORKERS,
+                )
+
+
+class TestGetPrMetrics(unittest.TestCase):
+    BASE_PR = {
+        "id": 1,
+        "title": "Add feature",
+        "author": {"display_name": "Alice"},
+        "state": "MERGED",
+        "created_on": "2024-01-01T10:00:00Z",
+        "updated_on": "2024-01-02T14:30:00Z",
+        "source": {"branch": {"name": "feature"}},
+        "destination": {"branch": {"name": "main"}},
+    }
+
+    def setUp(self):
+        self.responses = {
+            BASE_URL: {
+                "participants": [
+                    {"role": "REVIEWER"},
+                    {"role": "REVIEWER"},
+                    {"role": "PARTICIPANT"},
+                ]
+            },
+            f"{BASE_URL}/commits": {"values": [{"hash": "a"}, {"hash": "b"}]},
+            f"{BASE_URL}/comments": {"size": 1, "values": [{"id": 1}]},
+        }
+        self.paged = {
+            f"{BASE_URL}/diffstat": [
+                {"lines_added": 10, "lines_removed": 2},
+                {"lines_added": 5, "lines_removed": 1},
+                {"lines_added": None, "lines_removed": None},
+            ],
+        }
+        self.cloud = FakeCloud(self.responses, self.paged)
+        self.executor = ThreadPoolExecutor(max_workers=PR_REQUEST_WORKERS)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_review_time(self):
+        """
+        Test review time is measured from creation to merge, and only for merged PRs
+        """
+        no_update = {k: v for k, v in self.BASE_PR.items() if k != "updated_on"}
+        cases = [
+            ("merged", self.BASE_PR, 28.5),
+            ("open", {**self.BASE_PR, "state": "OPEN"}, None),
+            ("merged without updated_on", no_update, None),
+        ]
+        for name, pr, hours in cases:
+            with self.subTest(name):
+                result = get_pr_metrics(
+                    self.cloud, "workspace", "repo", pr, self.executor
+                )
+                if hours is None:
+                    self.assertIsNone(result["review_time_hours"])
+                    self.assertIsNone(result["review_time_days"])
+                else:
+                    self.assertAlmostEqual(result["review_time_hours"], hours)
+                    self.assertAlmostEqual(result["review_time_days"], hours / 24)
+
+    def test_counts_extraction(self):
+        """
+        Test reviewer, commit and comment counts
+        """
+        result = get_pr_metrics(
+            self.cloud, "workspace", "repo", self.BASE_PR, self.executor
+        )
+        self.assertIn(
+            (BASE_URL, {"params": {"fields": "participants.role"}}), self.cloud.calls
+        )
+        self.assertEqual(result["reviewer_count"], 2)
+        self.assertEqual(result["commits_count"], 2)
+        self.assertEqual(result["comments_count"], 1)
+
+    def test_participants_reused_from_listing(self):
+        """
+        Test participants included in the listed PR skip the detail request
+        """
+        pr = {**self.BASE_PR, "participants": [{"role": "REVIEWER"}]}
+        result = get_pr_metrics(self.cloud, "workspace", "repo", pr, self.executor)
+        self.assertEqual(result["reviewer_count"], 1)
+        self.assertNotIn(BASE_URL, [url for url, _ in self.cloud.calls])
+
+    def test_commits_counted_across_pages(self):
+        """
+        Test collections without a size are counted by following next links
+        """
+        next_url = "https://api.bitbucket.org/2.0/next"
+        self.responses[f"{BASE_URL}/commits"]["next"] = next_url
+        self.responses[next_url] = {"values": [{"hash": "c"}]}
+        result = get_pr_metrics(
+            self.cloud, "workspace", "repo", self.BASE_PR, self.executor
+        )
+        self.assertEqual(result["commits_count"], 3)
+        self.assertIn((next_url, {"absolute": True}), self.cloud.calls)
+
+    def test_diffstat_extraction(self):
+        """
+        Test lines added/removed and files changed are summed from the diffstat
+        """
+        result = get_pr_metrics(
+            self.cloud, "workspace", "repo", self.BASE_PR, self.executor
+        )
+        self.assertEqual(result["lines_added"], 15)
+        self.assertEqual(result["lines_removed"], 3)
+        self.assertEqual(result["total_lines_changed"], 18)
+        self.assertEqual(result["files_changed"], 3)
+
+    def test_diffstat_not_found(self):
+        """
+        Test a missing diffstat results in zeroed code changes
+        """
+        self.paged[f"{BASE_URL}/diffstat"] = http_error(404)
+        result = get_pr_metrics(
+            self.cloud, "workspace", "repo", self.BASE_PR, self.executor
+        )
+        self.assertEqual(result["lines_added"], 0)
+        self.assertEqual(result["lines_removed"], 0)
+        self.assertEqual(result["files_changed"], 0)
+
+    def test_diffstat_api_failure(self):
+        """
+        Test exhausted 5xx retries fail the PR instead of zeroing the metrics
+        """
+        # The session's Retry adapter raises RetryError once 5xx retries run out
+        self.paged[f"{BASE_URL}/diffstat"] = requests.exceptions.RetryError(
+            "Max retries exceeded (too many 500 error responses)"
+        )
+        with redirect_stdout(io.StringIO()) as stdout:
+            result = analyze_pr(
+                self.cloud, "workspace", "repo", self.BASE_PR, self.executor
+            )
+        self.assertIsNone(result)
+        self.assertIn("Error analyzing PR #1: Max retries exceeded", stdout.getvalue())
+
+
+class TestAnalyzePullRequests(unittest.TestCase):
+    def test_rows_written_in_order_and_failures_skipped(self):
+        """
+        Test each analyzed PR is written as a CSV row in order, skipping failures
+        """
+        prs = [{"id": pr_id, "title": f"PR {pr_id}"} for pr_id in (1, 2, 3)]
+
+        def fake_analyze_pr(cloud, workspace, repo, pr, executor, cache):
+            if pr["id"] == 2:
+                return None
+            return {name: pr["id"] for name in CSV_FIELDNAMES}
+
+        buf = io.StringIO()
+        with (
+            patch("main.analyze_pr", side_effect=fake_analyze_pr),
+            redirect_stdout(io.StringIO()),
+        ):
+            summary = analyze_pull_requests(
+                MagicMock(), "workspace", "repo", prs, csv.writer(buf)
+            )
+
+        self.assertEqual(summary.count, 2)
+        rows = list(csv.reader(io.StringIO(buf.getvalue())))
+        self.assertEqual([row[0] for row in rows], ["1", "3"])
+
+    def test_interrupt_lets_running_prs_finish(self):
+        """
+        Test PRs still running after Ctrl-C can use the request pool without errors
+        """
+        prs = [{"id": pr_id, "title": f"PR {pr_id}"} for pr_id in (1, 2)]
+        started = threading.Event()
+        finished = []
+
+        def fake_analyze_pr(cloud, workspace, repo, pr, executor, cache):
+            if pr["id"] == 1:
+                # Interrupt only once PR 2 is running rather than still queued
+                started.wait(timeout=5)
+                raise KeyboardInterrupt
+            started.set()
+            time.sleep(0.1)
+            finished.append(executor.submit(lambda: pr["id"]).result())
+
+        with (
+            patch("main.analyze_pr", side_effect=fake_analyze_pr),
+            redirect_stdout(io.StringIO()) as stdout,
+        ):
+            analyze_pull_requests(
+                MagicMock(), "workspace", "repo", prs, csv.writer(io.StringIO()), jobs=2
+            )
+
+        self.assertIn("Operation cancelled by user", stdout.getvalue())
+        self.assertEqual(finished, [2])
+
+    def test_request_pool_sized_from_jobs(self):
+        """
+        Test the per-PR request pool matches the session's connection pool
+        """
+        with (
+            patch("main.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as pool,
+            redirect_stdout(io.StringIO()),
+        ):
+            analyze_pull_requests(
+                MagicMock(), "workspace", "repo", [], csv.writer(io.StringIO()), jobs=3
+            )
+        pool.assert_any_call(max_workers=3)
+        pool.assert_any_call(max_workers=3 * PR_REQUEST_WORKERS)
+
+
+class TestMetricsCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache")
+        self.cache = MetricsCache(self.path, "workspace", "repo")
+        self.pr = {"id": 1, "state": "MERGED", "updated_on": "2024-01-02T14:30:00Z"}
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_cached_metrics_skip_api_calls(self):
+        """
+        Test a cached merged PR is returned without calling Bitbucket
+        """
+        self.cache.set(self.pr, {"id": 1})
+        cloud = MagicMock()
+        self.assertEqual(
+            analyze_pr(cloud, "workspace", "repo", self.pr, None, self.cache),
+            {"id": 1},
+        )
+        cloud.get.assert_not_called()
+        cloud._get_paged.assert_not_called()
+
+    def test_open_prs_are_not_cached(self):
+        """
+        Test metrics for PRs that are not merged are never stored
+        """
+        pr = {**self.pr, "state": "OPEN"}
+        self.cache.set(pr, {"id": 1})
+        self.assertIsNone(self.cache.get(pr))
+
+    def test_updated_pr_misses_cache(self):
+        """
+        Test a PR updated since it was cached is fetched again
+        """
+        self.cache.set(self.pr, {"id": 1})
+        pr = {**self.pr, "updated_on": "2024-01-03T09:00:00Z"}
+        self.assertIsNone(self.cache.get(pr))
+
+    def test_entries_from_other_versions_are_ignored(self):
+        """
+        Test entries written with a different cache version are misses
+        """
+        self.cache.set(self.pr, {"id": 1})
+        with patch("main.CACHE_VERSION", CACHE_VERSION + 1):
+            self.assertIsNone(self.cache.get(self.pr))
+
+    def test_cache_failures_do_not_abort_analysis(self):
+        """
+        Test cache read errors count as misses and write errors are only reported
+        """
+        cache = MagicMock()
+        cache.get.side_effect = EOFError("Ran out of input")
+        cache.set.side_effect = OSError("disk full")
+        with (
+            patch("main.get_pr_metrics", return_value={"id": 1}) as get_pr_metrics,
+            redirect_stdout(io.StringIO()) as stdout,
+        ):
+            result = analyze_pr(MagicMock(), "workspace", "repo", self.pr, None, cache)
+        self.assertEqual(result, {"id": 1})
+        get_pr_metrics.assert_called_once()
+        self.assertIn("Error caching PR #1: disk full", stdout.getvalue())
+
+    def test_other_repos_miss_cache(self):
+        """
+        Test a PR with the same ID and update time in another repo is not served
+        """
+        self.cache.set(self.pr, {"id": 1})
+        self.cache.close()
+        self.cache = MetricsCache(self.path, "workspace", "other-repo")
+        self.assertIsNone(self.cache.get(self.pr))
+
+    def test_unreadable_cache_file_is_skipped(self):
+        """
+        Test a file that is not a cache database is reported and not used
+        """
+        path = os.path.join(self.tmpdir.name, "garbage")
+        with open(path, "w") as f:
+            f.write("not a cache database")
+        with redirect_stdout(io.StringIO()) as stdout:
+            self.assertIsNone(open_cache(path, "workspace", "repo"))
+        self.assertIn("continuing without it", stdout.getvalue())
+
+
+class TestBuildQuery(unittest.TestCase):
+    def test_no_filters(self):
+        """
+        Test no query is built when no filters are given
+        """
+        self.assertEqual(build_query(argparse.Namespace(author=None)), "")
+
+    def test_author_filter(self):
+        """
+        Test the author filter is pushed down with quotes escaped
+        """
+        args = argparse.Namespace(author='Alice "Al" Smith')
+        self.assertEqual(
+            build_query(args), 'author.display_name = "Alice \\"Al\\" Smith"'
+        )
+
+    def test_author_backslashes_escaped(self):
+        """
+        Test backslashes in the author are escaped before quotes
+        """
+        cases = [
+            ("Alice\\", 'author.display_name = "Alice\\\\"'),
+            ('Al\\"ice', 'author.display_name = "Al\\\\\\"ice"'),
+        ]
+        for author, expected in cases:
+            with self.subTest(author):
+                args = argparse.Namespace(author=author)
+                self.assertEqual(build_query(args), expected)
+
+    def test_cutoff_and_author_filters_combined(self):
+        """
+        Test the --days cutoff and author filters are combined into one query
+        """
+        cutoff = datetime(2024, 1, 1, 10, 0, 0, 123456, tzinfo=timezone.utc)
+        self.assertEqual(
+            build_query(argparse.Namespace(author="Alice"), cutoff),
+            'updated_on >= 2024-01-01T10:00:00+00:00 AND author.display_name = "Alice"',
+        )
+
+
+class TestCollectPrs(unittest.TestCase):
+    CUTOFF = "2024-01-02T14:30:00"
+
+    def test_pr_in_cutoff_second_is_included(self):
+        """
+        Test PRs updated within the cutoff second are kept, with or without fractions
+        """
+        for updated_on in (
+            "2024-01-02T14:30:00.123456+00:00",
+            "2024-01-02T14:30:00+00:00",
+        ):
+            with self.subTest(updated_on):
+                prs = [{"id": 1, "updated_on": updated_on}]
+                self.assertEqual(collect_prs(prs, cutoff=self.CUTOFF), prs)
+
+    def test_older_pr_stops_iteration(self):
+        """
+        Test the first PR older than the cutoff ends collection
+        """
+        prs = iter(
+            [
+                {"id": 3, "updated_on": "2024-01-03T09:00:00.000000+00:00"},
+                {"id": 2, "updated_on": "2024-01-02T14:29:59.999999+00:00"},
+                {"id": 1, "updated_on": "2024-01-04T09:00:00.000000+00:00"},
+            ]
+        )
+        collected = collect_prs(prs, cutoff=self.CUTOFF)
+        self.assertEqual([pr["id"] for pr in collected], [3])
+        self.assertEqual(next(prs)["id"], 1)
+
+    def test_limit_does_not_pull_next_pr(self):
+        """
+        Test reaching the limit stops without requesting another PR
+        """
+
+        def listing():
+            yield {"id": 2, "updated_on": "2024-01-03T09:00:00.000000+00:00"}
+            yield {"id": 1, "updated_on": "2024-01-03T08:00:00.000000+00:00"}
+            self.fail("requested a PR beyond the limit")
+
+        collected = collect_prs(listing(), limit=2, cutoff=self.CUTOFF)
+        self.assertEqual([pr["id"] for pr in collected], [2, 1])
+
+
+class TestValidateEnv(unittest.TestCase):
+    def test_missing_variables_exit(self):
+        """
+        Test the script exits listing the missing environment variables
+        """
+        stdout = io.StringIO()
+        with patch.dict(os.environ, {"BITBUCKET_USERNAME": "user"}, clear=True):
+            with self.assertRaises(SystemExit), redirect_stdout(stdout):
+                validate_env()
+        output = stdout.getvalue()
+        self.assertIn("BITBUCKET_API_TOKEN", output)
+        self.assertNotIn("export BITBUCKET_USERNAME", output)
+
+
+class TestParseArgs(unittest.TestCase):
+    def test_defaults(self):
+        """
+        Test the defaults when no options are given
+        """
+        args = parse_args([])
+        self.assertEqual(args.limit, 50)
+        self.assertEqual(args.jobs, 8)
+        self.assertEqual(args.cache, ".pr_cache")
+        self.assertFalse(args.no_cache)
+
+    def test_options(self):
+        """
+        Test options are parsed from the given argument list
+        """
+        args = parse_args(["--days", "7", "--author", "Alice", "--no-cache"])
+        self.assertEqual(args.days, 7)
+        self.assertEqual(args.author, "Alice")
+        self.assertTrue(args.no_cache)
+
+    def test_invalid_limit(self):
+        """
+        Test a --limit below 1 is rejected instead of sent as the page length
+        """
+        for value in ("0", "-1"):
+            with self.subTest(value):
+                with self.assertRaises(SystemExit), redirect_stderr(io.StringIO()):
+                    parse_args(["--limit", value])
+
+    def test_invalid_jobs(self):
+        """
+        Test an out-of-range --jobs value is rejected
+        """
+        with self.assertRaises(SystemExit), redirect_stderr(io.StringIO()):
+            parse_args(["--jobs", "0"])
+
+
+class TestJobsCount(unittest.TestCase):
+    def test_valid_jobs(self):
+        """
+        Test --jobs accepts values within range
+        """
+        self.assertEqual(jobs_count("1"), 1)
+        self.assertEqual(jobs_count("32"), 32)
+
+    def test_out_of_range_jobs(self):
+        """
+        Test --jobs rejects values outside 1-32
+        """
+        for value in ("0", "33"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                jobs_count(value)
+
+
+class TestDescribe(unittest.TestCase):
+    def test_odd_number_of_values(self):
+        """
+        Test statistics for an odd number of values
+        """
+        stats = describe([5, 1, 3])
+        self.assertEqual(stats, Stats(average=3, median=3, min=1, max=5, total=9))
+
+    def test_even_number_of_values(self):
+        """
+        Test the median of an even number of values is the mean of the middle two
+        """
+        stats = describe([4, 1, 2, 10])
+        self.assertEqual(stats.median, 3)
+        self.assertEqual(stats.average, 4.25)
+
+
+class TestSummaryStats(unittest.TestCase):
+    def test_add_collects_columns(self):
+        """
+        Test metrics are collected per column, skipping missing review times
+        """
+        summary = SummaryStats()
+        metrics = {
+            "review_time_hours": None,
+            "reviewer_count": 2,
+            "commits_count": 3,
+            "comments_count": 4,
+            "lines_added": 10,
+            "lines_removed": 5,
+            "total_lines_changed": 15,
+            "files_changed": 1,
+        }
+        summary.add(metrics)
+        summary.add({**metrics, "review_time_hours": 12.0})
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(summary.columns["review_time_hours"], [12.0])
+        self.assertEqual(summary.columns["commits_count"], [3, 3])
+
+
+SAMPLE_METRICS = (
+    {
+        "review_time_hours": 24.0,
+        "reviewer_count": 1,
+        "commits_count": 2,
+        "comments_count": 3,
+        "lines_added": 1000,
+        "lines_removed": 20,
+        "total_lines_changed": 1020,
+        "files_changed": 2,
+    },
+    {
+        "review_time_hours": 60.0,
+        "reviewer_count": 2,
+        "commits_count": 3,
+        "comments_count": 5,
+        "lines_added": 500,
+        "lines_removed": 10,
+        "total_lines_changed": 510,
+        "files_changed": 1,
+    },
+)
+
+
+class TestPrintSummaryStats(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # print_summary_stats only reads the summary, so tests can share it
+        cls.summary = SummaryStats()
+        for metrics in SAMPLE_METRICS:
+            cls.summary.add(metrics)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.report = Path(self.tmpdir.name) / "report.md"
+
+    def test_no_prs(self):
+        """
+        Test an empty summary prints a notice and writes no report
+        """
+        stream = io.StringIO()
+        print_summary_stats(SummaryStats(), self.report, stream=stream)
+        self.assertEqual(stream.getvalue(), "No PRs to analyze\n")
+        self.assertFalse(self.report.exists())
+
+    def test_statistics_calculations(self):
+        """
+        Test the console summary shows the computed statistics
+        """
+        stream = io.StringIO()
+        print_summary_stats(self.summary, self.report, stream=stream)
+
+        expected = {
+            "Total PRs analyzed: 2",
+            "Average: 42.00 hours (1.75 days)",
+            "Commits per PR:\n  Average: 2.50",
+            "Comments per PR:\n  Average: 4.00",
+            "Reviewers per PR:\n  Average: 1.50",
+            "Total:   1500",
+        }
+        # One scan over the output; any missing line shows up in the set diff
+        pattern = re.compile("|".join(map(re.escape, expected)))
+        self.assertEqual(set(pattern.findall(stream.getvalue())), expected)
+
+    def test_markdown_file_generation(self):
+        """
+        Test the markdown report contains each section and table
+        """
+        print_summary_stats(self.summary, self.report, stream=io.StringIO())
+        content = self.report.read_text()
+
+        self.assertIn("# Pull Request Analysis Report", content)
+        self.assertIn("**Total PRs analyzed:** 2", content)
+        self.assertIn("| Average | 42.00 | 1.75 |", content)
+        self.assertIn("## Code Changes\n\n### Lines Added per PR", content)
+        self.assertIn("| Total | 1,500 |", content)
+
+
 if __name__ == "__main__":
     unittest.main()